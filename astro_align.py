@@ -79,7 +79,7 @@ def align_frames(ident, green=True, img_verbose=False):
 
         for fname in rgb_fnames:
             alipy.align.affineremap(fname, ident.trans, shape=output_shape,
-                                    makepng=args.img_verbose)
+                                    makepng=img_verbose)
     else:
         msg = "Unable to align image {}"
         raise RuntimeError(msg.format(ident.ukn.filepath))
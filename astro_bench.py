@@ -0,0 +1,607 @@
+#!/usr/bin/python3
+# *********************************************************************        
+# * Copyright (C) 2015 Jacopo Nespolo <j.nespolo@gmail.com>           *        
+# *                                                                   *
+# * For the license terms see the file LICENCE, distributed           *
+# * along with this software.                                         *
+# *********************************************************************
+#
+# This file is part of astrotools.
+# 
+# Astrotools is free software: you can redistribute it and/or modify it under 
+# the terms of the GNU General Public License as published by the Free Software 
+# Foundation, either version 3 of the License, or (at your option) any later 
+# version.
+# 
+# Astrotools is distributed in the hope that it will be useful, but WITHOUT ANY 
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS 
+# FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with astrotools.  If not, see <http://www.gnu.org/licenses/>
+#
+
+
+from sys import stdin, stderr, stdout, exit, argv
+from multiprocessing import get_context, cpu_count
+from argparse import Namespace
+from contextlib import redirect_stdout
+import argparse as ap
+import platform
+import resource
+import pickle
+import json
+import time
+import os
+import numpy as np
+
+par = ap.ArgumentParser(prog="astro_bench",
+                        description=("Benchmark the processing stages on "
+                                     "synthetic data."))
+par.add_argument("-s", "--stages", nargs='+', default=None,
+                 help=("Stages to benchmark, among: {}. "
+                       "(Default: all)").format(", ".join(
+                           ["develop", "identify", "align", "find_shift",
+                            "fuse_mean", "fuse_median", "video_distance"])))
+par.add_argument("-d", "--workdir", default="bench_data",
+                 help="Directory for the synthetic frames.")
+par.add_argument("-o", "--history", default="bench_history.json",
+                 help="JSON file the results are appended to.")
+par.add_argument("-g", "--geometry", nargs=2, type=int, default=[2048, 1365],
+                 help="Width and height of the star fields.")
+par.add_argument("-n", "--frames", type=int, default=10,
+                 help="Number of star field frames.")
+par.add_argument("--stars", type=int, default=300,
+                 help="Number of stars per field.")
+par.add_argument("--noise", type=float, default=10.,
+                 help="Standard deviation of the gaussian noise.")
+par.add_argument("--hot-pixels", type=int, default=50,
+                 help="Number of hot pixels, the same in every frame.")
+par.add_argument("--max-shift", type=float, default=20.,
+                 help="Maximum shift, in pixels, between frames.")
+par.add_argument("--max-rotation", type=float, default=1.,
+                 help="Maximum rotation, in degrees, between frames.")
+par.add_argument("--video-geometry", nargs=2, type=int, default=[640, 480],
+                 help="Width and height of the planetary video frames.")
+par.add_argument("--video-frames", type=int, default=100,
+                 help="Number of planetary video frames.")
+par.add_argument("-r", "--rows", type=int, default=100,
+                 help="Rows at a time for fuse_median.")
+par.add_argument("--raw-files", nargs='+', default=[],
+                 help=("RAW files for the develop stage, which cannot be run "
+                       "on synthetic data."))
+par.add_argument("--use-libraw", default=False, action='store_true',
+                 help="Use libraw in the develop stage.")
+par.add_argument("--seed", type=int, default=0,
+                 help="Random seed for the synthetic data.")
+par.add_argument("-k", "--keep", default=False, action='store_true',
+                 help="Reuse synthetic data already present in workdir.")
+
+
+STAGES = ["develop", "identify", "align", "find_shift", "fuse_mean", 
+          "fuse_median", "video_distance"]
+PSF_SIGMA = 1.5
+SKY_LEVEL = 100.
+HOT_PIXEL_VALUE = 60000.
+
+
+def render_star_field(shape, stars, dx=0., dy=0., theta=0., noise=10., 
+                      hot_pixels=None, rng=np.random):
+    '''
+    Render a star field, shifted by (dx, dy) and rotated by theta (radians) 
+    around the frame centre.
+    :param stars: tuple of arrays (x, y, flux) in the reference frame.
+    :param hot_pixels: tuple of arrays (y, x); these pixels are saturated 
+        regardless of the transformation, as on a real sensor.
+    '''
+    height, width = shape
+    image = np.full(shape, SKY_LEVEL, dtype=np.float32)
+    cy, cx = (height - 1) / 2, (width - 1) / 2
+    cos, sin = np.cos(theta), np.sin(theta)
+    x, y, fluxes = stars
+    xs = cos * (x - cx) - sin * (y - cy) + cx + dx
+    ys = sin * (x - cx) + cos * (y - cy) + cy + dy
+
+    radius = int(np.ceil(4 * PSF_SIGMA))
+    norm = 1 / (2 * np.pi * PSF_SIGMA**2)
+    for x, y, flux in zip(xs, ys, fluxes):
+        x0, x1 = max(int(x) - radius, 0), min(int(x) + radius + 1, width)
+        y0, y1 = max(int(y) - radius, 0), min(int(y) + radius + 1, height)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        r2 = (xx - x)**2 + (yy - y)**2
+        image[y0:y1, x0:x1] += flux * norm * np.exp(-r2 / (2 * PSF_SIGMA**2))
+
+    image += rng.normal(0, noise, shape).astype(np.float32)
+    if hot_pixels is not None:
+        image[hot_pixels] = HOT_PIXEL_VALUE
+    return image
+
+
+def render_planet(shape, dx=0., dy=0., noise=10., rng=np.random):
+    '''
+    Render a banded, limb-darkened planetary disk as a 16-bit RGB frame, 
+    shifted by (dx, dy) from the frame centre.
+    '''
+    height, width = shape
+    radius = min(shape) / 4
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    xx -= (width - 1) / 2 + dx
+    yy -= (height - 1) / 2 + dy
+    rho2 = (xx**2 + yy**2) / radius**2
+    disk = np.sqrt(np.clip(1 - rho2, 0, 1))
+    bands = 1 - 0.2 * np.sin(yy / radius * 12)**2
+    out_channels = []
+    for scale in (1., 0.85, 0.6):
+        channel = 40000 * scale * disk * bands
+        channel += rng.normal(0, noise, shape)
+        out_channels.append(np.uint16(np.clip(channel, 0, 2**16 - 1)))
+    return np.dstack(out_channels)
+
+
+def star_params(args):
+    '''
+    Parameters the synthetic star fields depend on.
+    '''
+    return {"geometry": args.geometry, "frames": args.frames, 
+            "stars": args.stars, "noise": args.noise, 
+            "hot_pixels": args.hot_pixels, "max_shift": args.max_shift,
+            "max_rotation": args.max_rotation, "seed": args.seed}
+
+
+def video_params(args):
+    '''
+    Parameters the synthetic planetary video depends on.
+    '''
+    return {"geometry": args.video_geometry, "frames": args.video_frames,
+            "noise": args.noise, "seed": args.seed}
+
+
+def load_kept(fname, params):
+    '''
+    Load the json description of previously generated data, if it exists 
+    and was generated with the same parameters. Otherwise return None.
+    '''
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as fin:
+        kept = json.load(fin)
+    if kept.get("params") != params:
+        return None
+    return kept
+
+
+def make_star_fields(args, rng):
+    '''
+    Write the synthetic star fields as FITS files, one per channel as 
+    astro_develop does. The generation parameters, the stars and the true 
+    transformation of each frame are written to truth.json, and returned.
+    '''
+    import pyfits
+
+    width, height = args.geometry
+    shape = (height, width)
+    stars = (rng.uniform(0, width, args.stars),
+             rng.uniform(0, height, args.stars),
+             2000 * (1 + rng.pareto(1.5, args.stars)))
+    hot_pixels = (rng.randint(0, height, args.hot_pixels),
+                  rng.randint(0, width, args.hot_pixels))
+
+    outdir = os.path.join(args.workdir, "stars")
+    os.makedirs(outdir, exist_ok=True)
+    # Identifications of the previous star fields do not apply any more.
+    identifications = os.path.join(outdir, "identifications.pickle")
+    if os.path.exists(identifications):
+        os.remove(identifications)
+    frames = []
+    for n in range(args.frames):
+        if n == 0:
+            dx, dy, theta = 0., 0., 0.
+        else:
+            dx, dy = rng.uniform(-args.max_shift, args.max_shift, 2)
+            theta = np.radians(rng.uniform(-args.max_rotation, 
+                                           args.max_rotation))
+        image = render_star_field(shape, stars, dx, dy, theta, 
+                                  noise=args.noise, hot_pixels=hot_pixels,
+                                  rng=rng)
+        basename = os.path.join(outdir, "frame_{:04d}".format(n))
+        for channel in (0, 1, 2):
+            hdu = pyfits.PrimaryHDU(data=image)
+            hdu.header.set('FILTER', channel)
+            hdu.writeto("{}_{}.fits".format(basename, channel), clobber=True)
+        frames.append({"file": "{}_1.fits".format(basename), 
+                       "dx": dx, "dy": dy, "theta": theta})
+
+    truth = {"params": star_params(args),
+             "stars": {"x": list(stars[0]), "y": list(stars[1]), 
+                       "flux": list(stars[2])},
+             "frames": frames}
+    with open(os.path.join(outdir, "truth.json"), 'w') as fout:
+        json.dump(truth, fout, indent=2)
+    return truth
+
+
+def make_video_frames(args, rng):
+    '''
+    Write the synthetic planetary video as a sequence of tiff frames, as 
+    extracted by astro_video. The generation parameters and the file names
+    are written to frames.json, and the file names returned.
+    '''
+    from skimage.io import imsave
+
+    width, height = args.video_geometry
+    outdir = os.path.join(args.workdir, "video")
+    os.makedirs(outdir, exist_ok=True)
+    fnames = []
+    for n in range(args.video_frames):
+        # atmospheric jitter
+        dx, dy = rng.normal(0, 3, 2)
+        frame = render_planet((height, width), dx, dy, noise=args.noise * 20,
+                              rng=rng)
+        fname = os.path.join(outdir, "frame-{:05d}.tif".format(n))
+        imsave(fname, frame, plugin='freeimage')
+        fnames.append(fname)
+
+    with open(os.path.join(outdir, "frames.json"), 'w') as fout:
+        json.dump({"params": video_params(args), "files": fnames}, fout, 
+                  indent=2)
+    return fnames
+
+
+def true_positions(frame, x, y, shape):
+    '''
+    Positions in frame of the points (x, y) of the reference frame, as 
+    rendered by render_star_field.
+    '''
+    height, width = shape
+    cy, cx = (height - 1) / 2, (width - 1) / 2
+    cos, sin = np.cos(frame["theta"]), np.sin(frame["theta"])
+    xs = cos * (x - cx) - sin * (y - cy) + cx + frame["dx"]
+    ys = sin * (x - cx) + cos * (y - cy) + cy + frame["dy"]
+    return xs, ys
+
+
+def transform_residual(trans, frame, shape):
+    '''
+    RMS distance, in pixels, between a grid of reference points and the 
+    same points mapped to frame with the true transformation and back with 
+    the alipy transform trans (which works in 1-based FITS coordinates).
+    '''
+    height, width = shape
+    y, x = np.mgrid[0:height:height // 8, 0:width:width // 8]
+    x, y = x.ravel().astype(float), y.ravel().astype(float)
+    xs, ys = true_positions(frame, x, y, shape)
+    xr, yr = trans.apply((xs + 1, ys + 1))
+    return np.sqrt(np.mean((xr - 1 - x)**2 + (yr - 1 - y)**2))
+
+
+def centroid_residual(image, stars, nstars=20, radius=5):
+    '''
+    Median distance, in pixels, between the centroids measured in image of 
+    the brightest stars and their positions in the reference frame.
+    '''
+    x, y, flux = (np.asarray(stars[key]) for key in ("x", "y", "flux"))
+    height, width = image.shape
+    yy, xx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    errors = []
+    for i in np.argsort(flux)[::-1]:
+        x0, y0 = int(round(x[i])), int(round(y[i]))
+        if not (radius <= x0 < width - radius and 
+                radius <= y0 < height - radius):
+            continue
+        box = image[y0 - radius:y0 + radius + 1, 
+                    x0 - radius:x0 + radius + 1].astype(np.float64)
+        box -= np.median(box)
+        box[box < 0] = 0
+        if box.sum() > 0:
+            cx = x0 + np.sum(box * xx) / box.sum()
+            cy = y0 + np.sum(box * yy) / box.sum()
+            errors.append(np.hypot(cx - x[i], cy - y[i]))
+        else:
+            errors.append(radius)
+        if len(errors) == nstars:
+            break
+    return float(np.median(errors))
+
+
+def peak_rss():
+    '''
+    Peak resident set size of this process, in MiB.
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(func, *args, **kwargs):
+    '''
+    Call func and return the wall time and the peak RSS before the call.
+    '''
+    rss_before = peak_rss()
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start, rss_before
+
+
+def bench_develop(args, data):
+    import astro_develop
+
+    if not args.raw_files:
+        return {"skipped": "no RAW files given (--raw-files)"}
+    # process_file writes the FITS files next to the name it is given.
+    outdir = os.path.join(args.workdir, "develop")
+    os.makedirs(outdir, exist_ok=True)
+    os.chdir(outdir)
+    fnames = []
+    for fname in args.raw_files:
+        link = os.path.basename(fname)
+        if not os.path.exists(link):
+            os.symlink(os.path.abspath(fname), link)
+        fnames.append(link)
+    dev_args = Namespace(use_libraw=args.use_libraw, 
+                         use_dcraw=not args.use_libraw,
+                         no_demosaic=False, lens_correction=False,
+                         output_channel=[0, 1, 2], verbose=False)
+
+    def run():
+        for fname in fnames:
+            astro_develop.process_file(fname, dev_args)
+    wall, rss_before = measure(run)
+    return {"wall": wall, "frames": len(fnames), "rss_before": rss_before}
+
+
+def bench_identify(args, data):
+    import alipy
+
+    fnames = data["stars"]
+    os.chdir(os.path.dirname(fnames[0]))
+    fnames = [os.path.basename(f) for f in fnames]
+    result = {}
+    def run():
+        result["identifications"] = alipy.ident.run(fnames[0], fnames, 
+                                                    visu=False)
+    wall, rss_before = measure(run)
+    identifications = result["identifications"]
+    with open("identifications.pickle", "wb") as fout:
+        pickle.dump(identifications, fout)
+
+    # Compare the recovered transforms to the true ones.
+    truth = dict((os.path.basename(frame["file"]), frame) 
+                 for frame in data["truth"]["frames"])
+    shape = args.geometry[::-1]
+    residuals = [transform_residual(ident.trans, 
+                                    truth[os.path.basename(
+                                        ident.ukn.filepath)], shape)
+                 for ident in identifications if ident.ok]
+    return {"wall": wall, "frames": len(fnames), "rss_before": rss_before,
+            "pixels": args.geometry[0] * args.geometry[1],
+            "unidentified": len(fnames) - len(residuals),
+            "residual": max(residuals) if residuals else None}
+
+
+def bench_align(args, data):
+    import alipy
+    import pyfits
+    import astro_align
+
+    fnames = data["stars"]
+    os.chdir(os.path.dirname(fnames[0]))
+    fnames = [os.path.basename(f) for f in fnames]
+    if os.path.exists("identifications.pickle"):
+        with open("identifications.pickle", "rb") as fin:
+            identifications = pickle.load(fin)
+    else:
+        identifications = alipy.ident.run(fnames[0], fnames, visu=False)
+    astro_align.output_shape = alipy.align.shape(fnames[0])
+
+    def run():
+        for ident in identifications:
+            astro_align.align_frames(ident, green=True)
+    wall, rss_before = measure(run)
+
+    # The stars of the aligned green channels should be back at their 
+    # positions in the reference frame.
+    residuals = []
+    for ident in identifications:
+        basename = os.path.splitext(os.path.basename(ident.ukn.filepath))[0]
+        aligned = pyfits.getdata(os.path.join("alipy_out", 
+                                              basename + "_affineremap.fits"))
+        residuals.append(centroid_residual(aligned, data["truth"]["stars"]))
+    # R, G and B are remapped for each identification.
+    return {"wall": wall, "frames": 3 * len(identifications), 
+            "rss_before": rss_before,
+            "pixels": args.geometry[0] * args.geometry[1],
+            "residual": max(residuals) if residuals else None}
+
+
+def _bench_fuse(args, data, median):
+    import pyfits
+    import astro_fuse
+
+    fnames = data["stars"]
+    input_frames = [pyfits.open(fname, memmap=True, mode='readonly')[0]
+                    for fname in fnames]
+    fuse_args = Namespace(rows=args.rows, verbose=False)
+    if median:
+        wall, rss_before = measure(astro_fuse.fuse_median, input_frames, 
+                                   fuse_args)
+    else:
+        wall, rss_before = measure(astro_fuse.fuse_mean, input_frames, 
+                                   fuse_args)
+    return {"wall": wall, "frames": len(fnames), "rss_before": rss_before,
+            "pixels": args.geometry[0] * args.geometry[1]}
+
+
+def bench_find_shift(args, data):
+    import pyfits
+    from astro_pipeline import box_spectrum, find_shift
+
+    box = 1024
+    images = [pyfits.getdata(fname) for fname in data["stars"]]
+    reference = np.conj(box_spectrum(images[0], box))
+    shifts = []
+    def run():
+        for image in images:
+            shifts.append(find_shift(image, reference, box))
+    wall, rss_before = measure(run)
+
+    # Rotations are not measured, but the shift of the centre of the box is.
+    # The box is square, see astro_pipeline.central_box.
+    errors = [np.hypot(dy - frame["dy"], dx - frame["dx"]) 
+              for (dy, dx), frame in zip(shifts, data["truth"]["frames"])]
+    return {"wall": wall, "frames": len(images), "rss_before": rss_before,
+            "pixels": min(box, *args.geometry)**2,
+            "residual": max(errors)}
+
+
+def bench_fuse_mean(args, data):
+    return _bench_fuse(args, data, median=False)
+
+
+def bench_fuse_median(args, data):
+    return _bench_fuse(args, data, median=True)
+
+
+def bench_video_distance(args, data):
+    import astro_video
+
+    fnames = data["video"]
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        reference = astro_video.load_frame(fnames[0])
+        wall, rss_before = measure(astro_video.distance, reference, fnames)
+    return {"wall": wall, "frames": len(fnames), "rss_before": rss_before,
+            "pixels": args.video_geometry[0] * args.video_geometry[1]}
+
+
+def run_stage(stage, args, data):
+    '''
+    Run a single benchmark. This is executed in a freshly spawned process, so
+    that the previous stages do not count towards its peak RSS. This still 
+    includes imports and inputs loaded before the timed section, hence the 
+    growth of the peak during the timed section is recorded as stage_rss.
+    '''
+    try:
+        result = globals()["bench_" + stage](args, data)
+    except ImportError as err:
+        return {"skipped": str(err)}
+    except Exception as err:
+        return {"error": repr(err)}
+    if "wall" in result:
+        result["peak_rss"] = peak_rss()
+        result["stage_rss"] = result["peak_rss"] - result["rss_before"]
+        result["frames_per_s"] = result["frames"] / result["wall"]
+        if "pixels" in result:
+            result["mpix_per_s"] = (result.pop("pixels") * result["frames"] /
+                                    result["wall"] / 1e6)
+    return result
+
+
+def load_history(fname):
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as fin:
+        return json.load(fin)
+
+
+def previous_run(history, params):
+    '''
+    Return the most recent run in history with the same parameters.
+    '''
+    for run in reversed(history):
+        if run["params"] == params:
+            return run
+    return None
+
+
+def report(results, previous=None):
+    header = "{:<16} {:>10} {:>10} {:>10} {:>10} {:>10} {:>9} {:>11}\n"
+    row    = ("{:<16} {:>10.3f} {:>10.2f} {:>10} {:>10.1f} {:>10.1f} {:>9} "
+              "{:>11}\n")
+    stdout.write(header.format("stage", "wall [s]", "frames/s", "MPix/s",
+                               "peak [MB]", "stage [MB]", "vs prev", 
+                               "resid [px]"))
+    for stage, result in results.items():
+        if "wall" not in result:
+            reason = result.get("skipped", result.get("error"))
+            stdout.write("{:<16} {}\n".format(stage, reason))
+            continue
+        mpix = result.get("mpix_per_s")
+        mpix = "-" if mpix is None else "{:.1f}".format(mpix)
+        ratio = "-"
+        if previous is not None:
+            prev = previous["results"].get(stage, {})
+            if "wall" in prev:
+                ratio = "{:+.1%}".format(result["wall"] / prev["wall"] - 1)
+        # distance from the known transformations, for the alignment stages
+        residual = result.get("residual")
+        residual = "-" if residual is None else "{:.2f}".format(residual)
+        stdout.write(row.format(stage, result["wall"], result["frames_per_s"],
+                                mpix, result["peak_rss"], 
+                                result["stage_rss"], ratio, residual))
+
+
+if __name__ == "__main__":
+    args = par.parse_args()
+    if args.stages is None:
+        args.stages = STAGES
+    for stage in args.stages:
+        if stage not in STAGES:
+            par.error("unknown stage {}".format(stage))
+    args.workdir = os.path.abspath(args.workdir)
+    args.raw_files = [os.path.abspath(f) for f in args.raw_files]
+    args.history = os.path.abspath(args.history)
+    
+    # Generate the synthetic data once, in this process. Data kept from a
+    # previous run is only reused if it was generated with the same 
+    # parameters, and star fields and video have their own random streams,
+    # so that either can be regenerated without affecting the other.
+    data = {}
+    if set(args.stages) & {"identify", "align", "find_shift", "fuse_mean", 
+                           "fuse_median"}:
+        truth = None
+        if args.keep:
+            truth = load_kept(os.path.join(args.workdir, "stars", 
+                                           "truth.json"), star_params(args))
+        if truth is None:
+            stderr.write("Generating star fields...\n")
+            truth = make_star_fields(args, np.random.RandomState(args.seed))
+        data["truth"] = truth
+        data["stars"] = [frame["file"] for frame in truth["frames"]]
+    if "video_distance" in args.stages:
+        video = None
+        if args.keep:
+            video = load_kept(os.path.join(args.workdir, "video", 
+                                           "frames.json"), video_params(args))
+        if video is None:
+            stderr.write("Generating planetary video...\n")
+            data["video"] = make_video_frames(
+                args, np.random.RandomState(args.seed + 1))
+        else:
+            data["video"] = video["files"]
+
+    # Each stage runs in its own process, so that it pays for its own 
+    # imports and its memory usage is not polluted by the previous stages.
+    results = {}
+    context = get_context("spawn")
+    for stage in args.stages:
+        stderr.write("Running {}...\n".format(stage))
+        with context.Pool(1) as pool:
+            results[stage] = pool.apply(run_stage, (stage, args, data))
+
+    params = dict((key, value) for key, value in vars(args).items()
+                  if key not in ("stages", "workdir", "history", "keep"))
+    history = load_history(args.history)
+    previous = previous_run(history, params)
+    report(results, previous)
+
+    history.append({"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "host": platform.node(),
+                    "cpus": cpu_count(),
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "params": params,
+                    "results": results})
+    with open(args.history, 'w') as fout:
+        json.dump(history, fout, indent=2)
+
+    exit(0)
@@ -185,9 +185,10 @@ def correct_distortion(img_array, img_exif):
         return np.dstack(out_channels)
 
 
-def process_file(fname, args):
+def develop_file(fname, args):
     '''
-    Convenience function that wraps the whole postprocessing from RAW to FITS.
+    Develop a RAW file into a numpy array, without writing anything to disk.
+    Returns the array and the FITS header built from the EXIF metadata.
     '''
     img_exif = extract_exif(fname)
     fits_header = FITS_header(fname, img_exif)
@@ -204,7 +205,15 @@ def process_file(fname, args):
 
     if args.lens_correction:
         img_array = correct_distortion(img_array, img_exif)
-        
+    return img_array, fits_header
+
+
+def process_file(fname, args):
+    '''
+    Convenience function that wraps the whole postprocessing from RAW to FITS.
+    '''
+    img_array, fits_header = develop_file(fname, args)
+
     for channel in args.output_channel:
         if args.no_demosaic:
             pack_FITS(fname, img_array, fits_header, channel)
@@ -23,21 +23,332 @@
 #
 
 from sys import stdin, stderr, stdout, exit, argv
+from multiprocessing import Pool
+from functools import partial
+from tempfile import mkstemp
 import argparse as ap
+import os
+import numpy as np
 from matplotlib import pyplot as plt
 import pyfits
 
 par = ap.ArgumentParser(prog="astro_fitspreview",
-                        description="Convert RAW image files to FITS.")
+                        description="Preview FITS files.")
 par.add_argument("filenames", nargs='+', help="Files to be processed")
+par.add_argument("-p", "--preview", default=False, action="store_true",
+                 help=("Show a decimated preview instead of the full frame. "
+                       "Only the needed pixels are read from disk. In either "
+                       "mode, the files are shown in a single window: "
+                       "right arrow, space or n go to the next file, left "
+                       "arrow or b to the previous one."))
+par.add_argument("-c", "--contact-sheet", default=None,
+                 help=("Render all the files as thumbnails into a single PNG "
+                       "with the given name, without opening any window. "
+                       "Each tile is labelled with its index; the list of "
+                       "files is written next to the PNG, as a .txt file."))
+par.add_argument("-s", "--size", type=int, default=1024,
+                 help=("Largest side, in pixels, of the decimated preview. "
+                       "(Default: 1024)"))
+par.add_argument("-t", "--tile-size", type=int, default=256,
+                 help=("Largest side of each contact sheet tile. "
+                       "(Default: 256)"))
+par.add_argument("-n", "--columns", type=int, default=None,
+                 help="Number of contact sheet columns. (Default: square)")
+par.add_argument("--clip", nargs=2, type=float, default=[0.5, 99.5],
+                 help=("Low and high percentiles used for the display "
+                       "stretch. (Default: 0.5 99.5)"))
+par.add_argument("--no-cache", default=False, action="store_true",
+                 help="Do not read or write the thumbnail cache.")
+
+
+# Number of pixels used to estimate the display stretch.
+STRETCH_SAMPLE = 2**16
+# Smallest level of the thumbnail pyramid.
+PYRAMID_MIN_SIZE = 64
+
+
+def cache_filename(fname):
+    '''
+    Name of the thumbnail cache file stored next to the FITS file.
+    '''
+    dirname, basename = os.path.split(fname)
+    return os.path.join(dirname, "." + basename + ".preview.npz")
+
+
+def image_plane(hdu):
+    '''
+    Return the raw (unscaled) data of the HDU as a 2D memmap view, together 
+    with the BSCALE and BZERO values that have to be applied to it.
+    If the data has more than two axes, the first plane is used.
+    '''
+    data = hdu.data
+    if data is None:
+        raise ValueError("no image data in the primary HDU")
+    while data.ndim > 2:
+        data = data[0]
+    bscale = hdu.header.get('BSCALE', 1.)
+    bzero  = hdu.header.get('BZERO', 0.)
+    return data, bscale, bzero
+
+
+def decimated_read(data, size):
+    '''
+    Read a strided section of data, such that its largest side is at most 
+    size pixels. Only the selected rows are touched on disk.
+    '''
+    step = max(1, -(-max(data.shape) // size))
+    return np.array(data[::step, ::step], dtype=np.float32)
+
+
+def stretch_limits(data, clip):
+    '''
+    Estimate the display stretch from a strided sample of about 
+    STRETCH_SAMPLE pixels.
+    '''
+    step = max(1, int(np.sqrt(data.size / STRETCH_SAMPLE)))
+    sample = data[::step, ::step]
+    low, high = np.percentile(sample, clip)
+    if high <= low:
+        high = low + 1
+    return low, high
+
+
+def stretch(data, low, high):
+    '''
+    Linear stretch of data between low and high, packed in 8 bits.
+    '''
+    out = (data - low) * (255. / (high - low))
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+
+
+def downsample(image):
+    '''
+    Halve the size of image by averaging 2x2 blocks.
+    '''
+    height = image.shape[0] // 2 * 2
+    width  = image.shape[1] // 2 * 2
+    image = image[:height, :width].astype(np.float32)
+    return np.uint8((image[0::2, 0::2] + image[1::2, 0::2] + 
+                     image[0::2, 1::2] + image[1::2, 1::2]) / 4)
+
+
+def build_pyramid(fname, size, clip):
+    '''
+    Read a decimated, stretched version of the first HDU of fname and 
+    return a list of thumbnails, each half the size of the previous one.
+    '''
+    frame_hdulist = pyfits.open(fname, memmap=True, mode='readonly', 
+                                do_not_scale_image_data=True)
+    data, bscale, bzero = image_plane(frame_hdulist[0])
+    preview = decimated_read(data, size) * bscale + bzero
+    frame_hdulist.close()
+
+    low, high = stretch_limits(preview, clip)
+    levels = [stretch(preview, low, high)]
+    while max(levels[-1].shape) // 2 >= PYRAMID_MIN_SIZE:
+        levels.append(downsample(levels[-1]))
+    return levels
+
+
+def load_pyramid(fname, size, clip, use_cache=True):
+    '''
+    Return the thumbnail pyramid of fname, reusing the cached one if it was 
+    built from the current version of the file with the same parameters.
+    '''
+    mtime = os.path.getmtime(fname)
+    cache = cache_filename(fname)
+    if use_cache and os.path.exists(cache):
+        try:
+            with np.load(cache) as cached:
+                if (cached['mtime'] == mtime and cached['size'] == size and 
+                    np.all(cached['clip'] == clip)):
+                    nlevels = int(cached['nlevels'])
+                    return [cached['level_{}'.format(i)] 
+                            for i in range(nlevels)]
+        except Exception:
+            # e.g. truncated by an interrupted write: just rebuild it.
+            pass
+
+    levels = build_pyramid(fname, size, clip)
+    if use_cache:
+        arrays = dict(('level_{}'.format(i), level) 
+                      for i, level in enumerate(levels))
+        # Write to a temporary file and rename it, so that the cache is 
+        # never seen half written.
+        try:
+            fd, tmpname = mkstemp(prefix=".", suffix=".npz.tmp",
+                                  dir=os.path.dirname(cache) or ".")
+        except (IOError, OSError):
+            # e.g. read-only directory: just go without cache.
+            return levels
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                np.savez(fout, mtime=mtime, size=size, clip=clip,
+                         nlevels=len(levels), **arrays)
+            os.rename(tmpname, cache)
+        except (IOError, OSError):
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+    return levels
+
+
+def pick_level(levels, size):
+    '''
+    Largest pyramid level whose largest side is at most size pixels, or the
+    smallest level if none fits.
+    '''
+    for level in levels:
+        if max(level.shape) <= size:
+            return level
+    return levels[-1]
+
+
+def shrink(image, size):
+    '''
+    Box-average image by the integer factor needed to bring its largest 
+    side to at most size pixels.
+    '''
+    factor = -(-max(image.shape) // size)
+    if factor <= 1:
+        return image
+    height = image.shape[0] // factor * factor
+    width  = image.shape[1] // factor * factor
+    blocks = image[:height, :width].reshape(height // factor, factor, 
+                                            width // factor, factor)
+    return np.uint8(blocks.mean(axis=(1, 3)))
+
+
+def load_thumbnail(fname, tile, size, clip, use_cache=True):
+    '''
+    Thumbnail of fname whose largest side is at most tile pixels, taken 
+    from its pyramid. Returns None if fname cannot be read, so that a single
+    broken file does not spoil the whole contact sheet.
+    '''
+    try:
+        levels = load_pyramid(fname, size, clip, use_cache=use_cache)
+    except Exception as err:
+        stderr.write("Unable to read {}: {}\n".format(fname, err))
+        return None
+    return shrink(pick_level(levels, tile), tile)
+
+
+def contact_sheet(fnames, args):
+    '''
+    Render all the frames as thumbnails into a single PNG.
+    '''
+    tile = args.tile_size
+    # Only the thumbnails travel back from the workers, not the pyramids.
+    partial_load_thumbnail = partial(load_thumbnail, tile=tile, 
+                                     size=args.size, clip=args.clip, 
+                                     use_cache=not args.no_cache)
+    pool = Pool()
+    thumbs = pool.map(partial_load_thumbnail, fnames)
+    pool.close()
+    pool.join()
+
+    ncols = args.columns
+    if ncols is None:
+        ncols = int(np.ceil(np.sqrt(len(fnames))))
+    nrows = -(-len(fnames) // ncols)
+    sheet = np.zeros((nrows * tile, ncols * tile), dtype=np.uint8)
+
+    for n, thumb in enumerate(thumbs):
+        if thumb is None:
+            continue
+        row = (n // ncols) * tile
+        col = (n  % ncols) * tile
+        sheet[row:row + thumb.shape[0], col:col + thumb.shape[1]] = thumb
+
+    # Draw the sheet at its native resolution, labelling each tile with its
+    # index in the file list; unreadable files get an empty tile in red.
+    plt.switch_backend('Agg')
+    dpi = 100.
+    height, width = sheet.shape
+    fig = plt.figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    fig.figimage(sheet, cmap='gray', vmin=0, vmax=255, origin='upper')
+    for n, thumb in enumerate(thumbs):
+        row = (n // ncols) * tile
+        col = (n  % ncols) * tile
+        label = str(n) if thumb is not None else "{} unreadable".format(n)
+        fig.text((col + 4.) / width, 1 - (row + 4.) / height, label, 
+                 color='yellow' if thumb is not None else 'red',
+                 fontsize=8, ha='left', va='top')
+    fig.savefig(args.contact_sheet, dpi=dpi)
+    plt.close(fig)
+
+    with open(os.path.splitext(args.contact_sheet)[0] + ".txt", 'w') as fout:
+        for n, (fname, thumb) in enumerate(zip(fnames, thumbs)):
+            status = "" if thumb is not None else "\tunreadable"
+            fout.write("{}\t{}{}\n".format(n, fname, status))
+
+
+def load_preview(fname, args):
+    '''
+    Decimated preview of fname, with the arguments to display it.
+    '''
+    image = load_pyramid(fname, args.size, args.clip,
+                         use_cache=not args.no_cache)[0]
+    return image, {"cmap": 'gray', "vmin": 0, "vmax": 255}
+
+
+def load_full(fname, args):
+    '''
+    Full frame of fname, with the arguments to display it.
+    '''
+    frame_hdulist = pyfits.open(fname, memmap=True, mode='readonly')
+    frame = frame_hdulist[0]
+    return 1 - frame.data, {"cmap": 'Greys'}
+
+
+def browse(fnames, load, args):
+    '''
+    Show the files one at a time in a single window, stepping through them 
+    with the keyboard.
+    '''
+    # The arrows are bound to the view history by default.
+    for keymap, key in (('keymap.back', 'left'), ('keymap.forward', 'right')):
+        if key in plt.rcParams[keymap]:
+            plt.rcParams[keymap].remove(key)
+
+    fig, ax = plt.subplots()
+    position = [0]
+
+    def show():
+        fname = fnames[position[0]]
+        ax.clear()
+        try:
+            image, kwargs = load(fname, args)
+            ax.imshow(image, **kwargs)
+            title = fname
+        except Exception as err:
+            title = "{}: {}".format(fname, err)
+        ax.set_title("[{}/{}] {}".format(position[0] + 1, len(fnames), title))
+        fig.canvas.draw_idle()
+
+    def on_key(event):
+        if event.key in ('right', ' ', 'n'):
+            position[0] = min(position[0] + 1, len(fnames) - 1)
+        elif event.key in ('left', 'b'):
+            position[0] = max(position[0] - 1, 0)
+        else:
+            return
+        show()
+
+    fig.canvas.mpl_connect('key_press_event', on_key)
+    show()
+    plt.show()
+
 
 if __name__ == "__main__":
     args = par.parse_args()
+
+    if args.contact_sheet is not None:
+        contact_sheet(args.filenames, args)
+        exit(0)
     
-    for fname in args.filenames:
-        frame_hdulist = pyfits.open(fname, memmap=True, mode='readonly')
-        frame = frame_hdulist[0]
-        imgplot = plt.imshow(1 - frame.data)
-        imgplot.set_cmap('Greys')
-        plt.show()
+    if args.preview:
+        browse(args.filenames, load_preview, args)
+    else:
+        browse(args.filenames, load_full, args)
     exit(0)
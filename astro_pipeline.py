@@ -0,0 +1,643 @@
+#!/usr/bin/python3
+# *********************************************************************        
+# * Copyright (C) 2015 Jacopo Nespolo <j.nespolo@gmail.com>           *        
+# *                                                                   *
+# * For the license terms see the file LICENCE, distributed           *
+# * along with this software.                                         *
+# *********************************************************************
+#
+# This file is part of astrotools.
+# 
+# Astrotools is free software: you can redistribute it and/or modify it under 
+# the terms of the GNU General Public License as published by the Free Software 
+# Foundation, either version 3 of the License, or (at your option) any later 
+# version.
+# 
+# Astrotools is distributed in the hope that it will be useful, but WITHOUT ANY 
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS 
+# FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along 
+# with astrotools.  If not, see <http://www.gnu.org/licenses/>
+#
+
+
+from sys import stdin, stdout, stderr, argv, exit
+from multiprocessing import get_context, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+from tempfile import NamedTemporaryFile
+from threading import Thread, Event
+from queue import Empty, Full
+import argparse as ap
+import resource
+import json
+import time
+import os
+
+import numpy as np
+from scipy.ndimage import shift as ndshift, affine_transform, median_filter
+import pyfits
+
+from astro_develop import develop_file, pack_FITS
+
+par = ap.ArgumentParser(prog="astro_pipeline",
+                        description=("Develop, calibrate, align and stack RAW "
+                                     "files in a single run, keeping the "
+                                     "frames in memory."))
+par.add_argument("filenames", nargs='+', 
+                 help=("Files to be processed. The first one is the "
+                       "reference frame for the alignment."))
+par.add_argument("-o", "--output-file", default="output.fits",
+                 help=("Output file name. One file per channel is written, "
+                       "as output_0.fits, output_1.fits, output_2.fits."))
+par.add_argument("-l", '--lens-correction', default=False, action='store_true',
+                 help="Apply lens distortion correction.")
+par.add_argument('--use-libraw', default=False, action='store_true',
+                 help="Use libraw for raw development.")
+par.add_argument('--use-dcraw', default=True, action='store_true',
+                 help="Use dcraw for raw development (default).")
+par.add_argument("--dark", nargs='+', default=None,
+                 help=("Master dark frame: either one FITS file per channel, "
+                       "or a single one used for all channels."))
+par.add_argument("--bias", nargs='+', default=None,
+                 help=("Master bias frame, as for --dark. It is only "
+                       "subtracted from the frames if no dark is given, "
+                       "since the dark already contains the bias."))
+par.add_argument("--flat", nargs='+', default=None,
+                 help="Master flat frame, as for --dark.")
+par.add_argument("--no-align", default=False, action='store_true',
+                 help="Do not align the frames.")
+par.add_argument("-b", "--align-box", type=int, default=1024,
+                 help=("Side of the central box used to measure the shift "
+                       "between frames. (Default: 1024)"))
+par.add_argument("--allow-zero-shift", default=False, action='store_true',
+                 help=("Keep frames whose correlation peak is at zero "
+                       "shift, to the pixel. By default they are skipped, "
+                       "since that usually means that a fixed pattern (e.g. "
+                       "hot pixels) dominates the correlation. Use it with "
+                       "well-guided frames."))
+par.add_argument("--alipy", default=False, action='store_true',
+                 help=("Align with alipy, which also corrects rotations. "
+                       "The green channel is written to a temporary file "
+                       "for the identification."))
+par.add_argument("-j", "--develop-jobs", type=int, default=None,
+                 help="Number of develop workers. (Default: optimise)")
+par.add_argument("--calibrate-jobs", type=int, default=1,
+                 help="Number of calibrate workers. (Default: 1)")
+par.add_argument("--align-jobs", type=int, default=2,
+                 help="Number of align workers. (Default: 2)")
+par.add_argument("-q", "--queue-size", type=int, default=2,
+                 help=("Maximum number of frames waiting between two stages. "
+                       "(Default: 2)"))
+par.add_argument("-m", "--max-frames", type=int, default=4,
+                 help=("Maximum number of frames in flight, i.e. the size, "
+                       "in frames, of the shared memory buffer. Each frame "
+                       "takes 12 bytes per pixel. (Default: 4)"))
+par.add_argument("-c", "--checkpoint", type=int, default=None,
+                 help=("Write the partial stack every this many frames, "
+                       "as output_checkpoint_0.fits, etc."))
+par.add_argument("-s", "--stats", default=None,
+                 help="Write the per-stage timing and memory to this file.")
+par.add_argument("-v", '--verbose', default=False, action='store_true',
+                 help="Print verbose output.")
+
+
+def peak_rss():
+    '''
+    Peak resident set size of this process, in MiB. Pages of the shared frame
+    buffer touched by the process are accounted for, too.
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_master(fnames, nchannels):
+    '''
+    Load a master frame, either from one FITS file per channel, or from a 
+    single FITS file used for all the channels.
+    '''
+    if fnames is None:
+        return None
+    if len(fnames) not in (1, nchannels):
+        msg = "Expected 1 or {} master frames, got {}"
+        raise ValueError(msg.format(nchannels, len(fnames)))
+    planes = [pyfits.getdata(fname).astype(np.float32) for fname in fnames]
+    if len(planes) == 1:
+        planes = planes * nchannels
+    return np.dstack(planes)
+
+
+def load_masters(args, nchannels):
+    '''
+    Prepare the master frames for calibrate_frame. Returns the frame to be 
+    subtracted and the normalised flat, either of which can be None.
+    '''
+    dark = load_master(args.dark, nchannels)
+    bias = load_master(args.bias, nchannels)
+    flat = load_master(args.flat, nchannels)
+    if flat is not None:
+        if bias is not None:
+            flat -= bias
+        flat /= np.mean(flat, axis=(0, 1))
+        flat[flat <= 0] = 1.
+    if dark is None:
+        dark = bias
+    return dark, flat
+
+
+def calibrate_frame(frame, masters):
+    '''
+    Dark (or bias) subtraction and flat field correction, in place.
+    '''
+    dark, flat = masters
+    if dark is not None:
+        frame -= dark
+    if flat is not None:
+        frame /= flat
+
+
+def central_box(image, box):
+    height, width = image.shape
+    box = min(box, height, width)
+    y0 = (height - box) // 2
+    x0 = (width - box) // 2
+    return image[y0:y0 + box, x0:x0 + box]
+
+
+def box_spectrum(image, box):
+    '''
+    Fourier transform of the windowed central box of image. The box is 
+    median filtered first: otherwise fixed-pattern outliers such as hot 
+    pixels, which do not move between frames, dominate the correlation.
+    '''
+    crop = median_filter(central_box(image, box), size=3)
+    window = np.outer(np.hanning(crop.shape[0]), np.hanning(crop.shape[1]))
+    return np.fft.rfft2((crop - crop.mean()) * window)
+
+
+def correlation_peak(image, reference_spectrum, box):
+    '''
+    Phase correlation of the central box of image with the reference. 
+    Returns the correlation and the integer position of its peak.
+    :param reference_spectrum: complex conjugate of box_spectrum of the 
+        reference.
+    '''
+    cross = box_spectrum(image, box) * reference_spectrum
+    cross /= np.abs(cross) + 1e-12
+    corr = np.fft.irfft2(cross, s=central_box(image, box).shape)
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    return corr, peak
+
+
+def refine_peak(corr, peak):
+    '''
+    Shift (dy, dx) corresponding to the correlation peak, with sub-pixel 
+    parabolic refinement.
+    '''
+    shift = []
+    for axis, p in enumerate(peak):
+        n = corr.shape[axis]
+        before, after = list(peak), list(peak)
+        before[axis] = (p - 1) % n
+        after[axis]  = (p + 1) % n
+        c_before, c_peak, c_after = (corr[tuple(before)], corr[peak], 
+                                     corr[tuple(after)])
+        denom = c_before - 2 * c_peak + c_after
+        delta = 0.5 * (c_before - c_after) / denom if denom != 0 else 0.
+        s = p + delta
+        if s > n / 2:
+            s -= n
+        shift.append(s)
+    return shift
+
+
+def find_shift(image, reference_spectrum, box):
+    '''
+    Shift (dy, dx) of image with respect to the reference, measured by phase 
+    correlation of the central box, with sub-pixel parabolic refinement.
+    :param reference_spectrum: complex conjugate of box_spectrum of the 
+        reference.
+    '''
+    return refine_peak(*correlation_peak(image, reference_spectrum, box))
+
+
+# Stage functions. Each of them gets the frame (a view on the shared buffer)
+# and the state returned by the corresponding init function, and works in 
+# place.
+
+def init_calibrate(args, shape):
+    return load_masters(args, shape[2])
+
+
+def run_calibrate(frame, state):
+    calibrate_frame(frame, state)
+
+
+def init_align(args, shape):
+    if args.alipy:
+        import alipy
+        # As in alipy.ident.run, but the catalogue and the quads of the 
+        # reference are only built once, rather than for every frame.
+        reference = alipy.imgcat.ImgCat(args.reference_file)
+        reference.makecat(rerun=True, keepcat=False, verbose=False)
+        reference.makestarlist(skipsaturated=False, n=500, verbose=False)
+        reference.makemorequads(verbose=False)
+        return {"alipy": alipy, "reference": reference}
+    return {"box": args.align_box, 
+            "reference": np.load(args.reference_file),
+            "allow_zero_shift": args.allow_zero_shift}
+
+
+def run_align(frame, state):
+    if "alipy" in state:
+        alipy = state["alipy"]
+        with NamedTemporaryFile(suffix=".fits") as tmpfile:
+            pyfits.PrimaryHDU(data=frame[:, :, 1]).writeto(tmpfile.name, 
+                                                          clobber=True)
+            unknown = alipy.imgcat.ImgCat(tmpfile.name)
+            unknown.makecat(rerun=True, keepcat=False, verbose=False)
+            unknown.makestarlist(skipsaturated=False, n=500, verbose=False)
+            ident = alipy.ident.Identification(state["reference"], unknown)
+            ident.findtrans(r=5.0, verbose=False)
+        if not ident.ok:
+            raise RuntimeError("Unable to align image")
+        # As in alipy.align.affineremap. alipy works on transposed arrays.
+        matrix, offset = ident.trans.inverse().matrixform()
+        for c in range(frame.shape[2]):
+            frame[:, :, c] = affine_transform(frame[:, :, c].T, matrix, 
+                                              offset=offset, order=1).T
+    else:
+        corr, peak = correlation_peak(frame[:, :, 1], state["reference"], 
+                                      state["box"])
+        # The reference never gets here: it goes straight to the stack.
+        if peak == (0, 0) and not state["allow_zero_shift"]:
+            raise RuntimeError("Correlation peak at zero shift, unable to "
+                               "align image")
+        dy, dx = refine_peak(corr, peak)
+        for c in range(frame.shape[2]):
+            frame[:, :, c] = ndshift(frame[:, :, c], (-dy, -dx), order=1)
+
+
+STAGE_INIT = {"calibrate": init_calibrate, "align": init_align}
+STAGE_RUN  = {"calibrate": run_calibrate, "align": run_align}
+
+
+def new_stats(stage):
+    return {"stage": stage, "pid": os.getpid(), "frames": 0, "failed": 0,
+            "busy": 0., "wait_in": 0., "wait_out": 0.}
+
+
+def worker(stage, inqueue, outqueue, free_slots, events, buffer_name, 
+           nslots, shape, args):
+    '''
+    Worker loop of a stage. Frames travel between stages as indices of slots
+    in the shared buffer; the develop stage takes a free slot for every new 
+    frame. Gets file names (develop) or (slot, file name) tuples from 
+    inqueue until None is received.
+    Reports ("ready", stage, error) on events once initialised, error being
+    None on success, and ("stats", stats) before exiting.
+    '''
+    try:
+        shm = SharedMemory(name=buffer_name)
+        frames = np.ndarray((nslots,) + shape, dtype=np.float32, 
+                            buffer=shm.buf)
+        if stage != "develop":
+            state = STAGE_INIT[stage](args, shape)
+    except Exception as err:
+        events.put(("ready", stage, repr(err)))
+        return
+    events.put(("ready", stage, None))
+    stats = new_stats(stage)
+
+    while True:
+        start = time.perf_counter()
+        item = inqueue.get()
+        stats["wait_in"] += time.perf_counter() - start
+        if item is None:
+            break
+
+        start = time.perf_counter()
+        slot_wait = 0.
+        try:
+            if stage == "develop":
+                fname = item
+                img_array, _ = develop_file(fname, args)
+                if img_array.shape != shape:
+                    msg = "Frame shape {} differs from reference {}"
+                    raise ValueError(msg.format(img_array.shape, shape))
+                # waiting for a free slot is backpressure from downstream.
+                slot_start = time.perf_counter()
+                slot = free_slots.get()
+                slot_wait = time.perf_counter() - slot_start
+                stats["wait_out"] += slot_wait
+                frames[slot] = img_array
+                del img_array
+                item = (slot, fname)
+            else:
+                STAGE_RUN[stage](frames[item[0]], state)
+        except Exception as err:
+            stderr.write("{}: skipping {}: {}\n".format(stage, item, err))
+            if isinstance(item, tuple):
+                free_slots.put(item[0])
+            stats["failed"] += 1
+            continue
+        stats["busy"] += time.perf_counter() - start - slot_wait
+        stats["frames"] += 1
+
+        start = time.perf_counter()
+        outqueue.put(item)
+        stats["wait_out"] += time.perf_counter() - start
+
+    stats["peak_rss"] = peak_rss()
+    events.put(("stats", stats))
+    del frames
+    shm.close()
+
+
+def dead_workers(stages):
+    '''
+    Names of the stages with workers that exited abnormally, e.g. killed by 
+    the OOM killer or by a crash in a C extension.
+    '''
+    return sorted(set(stage for stage, procs in stages for proc in procs
+                      if proc.exitcode not in (None, 0)))
+
+
+def coordinate(fnames, stages, queues, stop):
+    '''
+    Feed the file names to the first stage, then shut down the stages in 
+    order, once the upstream one is done. Gives up as soon as stop is set, 
+    since the workers that should consume the queues may be dead.
+    '''
+    def put(queue, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Full:
+                pass
+        return False
+
+    for fname in fnames:
+        if not put(queues[0], fname):
+            return
+    for n, (stage, procs) in enumerate(stages):
+        for proc in procs:
+            if not put(queues[n], None):
+                return
+        for proc in procs:
+            while proc.exitcode is None:
+                if stop.is_set():
+                    return
+                proc.join(timeout=1)
+    put(queues[-1], None)
+
+
+def wait_ready(events, stages):
+    '''
+    Wait for all the workers to be initialised, and abort if any of them 
+    failed to.
+    '''
+    nworkers = sum(len(procs) for _, procs in stages)
+    while nworkers > 0:
+        try:
+            event = events.get(timeout=1)
+        except Empty:
+            dead = dead_workers(stages)
+            if dead:
+                msg = "{} worker died during initialisation"
+                raise RuntimeError(msg.format(", ".join(dead)))
+            continue
+        _, stage, error = event
+        if error is not None:
+            msg = "unable to initialise {} worker: {}"
+            raise RuntimeError(msg.format(stage, error))
+        nworkers -= 1
+
+
+def report(stats, wall):
+    '''
+    Aggregate the per-worker stats by stage, and print them. The stage with 
+    the highest utilisation is the bottleneck.
+    '''
+    summary = {}
+    for s in stats:
+        stage = summary.setdefault(s["stage"], 
+                                   {"workers": 0, "frames": 0, "failed": 0, 
+                                    "busy": 0., "wait_in": 0., "wait_out": 0.,
+                                    "peak_rss": 0.})
+        stage["workers"] += 1
+        for key in ("frames", "failed", "busy", "wait_in", "wait_out"):
+            stage[key] += s[key]
+        stage["peak_rss"] = max(stage["peak_rss"], s["peak_rss"])
+    for stage in summary.values():
+        stage["utilisation"] = stage["busy"] / (stage["workers"] * wall)
+
+    header = "{:<10} {:>7} {:>7} {:>7} {:>9} {:>9} {:>9} {:>6} {:>10}\n"
+    row    = ("{:<10} {:>7} {:>7} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>6.0%} "
+              "{:>10.1f}\n")
+    stderr.write(header.format("stage", "workers", "frames", "failed", 
+                               "busy [s]", "in [s]", "out [s]", "util", 
+                               "peak [MB]"))
+    for name, stage in summary.items():
+        stderr.write(row.format(name, stage["workers"], stage["frames"],
+                                stage["failed"], stage["busy"], 
+                                stage["wait_in"], 
+                                stage["wait_out"], stage["utilisation"],
+                                stage["peak_rss"]))
+    bottleneck = max(summary, key=lambda name: summary[name]["utilisation"])
+    stderr.write("Total {:.1f} s, bottleneck: {}\n".format(wall, bottleneck))
+    return summary
+
+
+def run(args):
+    '''
+    Run the whole pipeline and write the stack. Raises RuntimeError if the 
+    pipeline cannot complete, in which case no output is written.
+    Returns the per-stage summary.
+    '''
+    wall_start = time.perf_counter()
+
+    # The reference frame is developed and calibrated here: it sets the 
+    # frame shape, the output header and the alignment reference.
+    reference, header = develop_file(args.filenames[0], args)
+    shape = reference.shape
+    reference = reference.astype(np.float32)
+    calibrated = args.dark or args.bias or args.flat
+    if calibrated:
+        calibrate_frame(reference, load_masters(args, shape[2]))
+
+    stage_jobs = [("develop", args.develop_jobs)]
+    if calibrated:
+        stage_jobs.append(("calibrate", args.calibrate_jobs))
+    if not args.no_align:
+        stage_jobs.append(("align", args.align_jobs))
+
+    # Shared buffer with a slot for every frame that can be in flight.
+    nslots = args.max_frames
+    frame_bytes = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+    if os.path.isdir("/dev/shm"):
+        shm_stat = os.statvfs("/dev/shm")
+        available = shm_stat.f_bavail * shm_stat.f_frsize
+        if nslots * frame_bytes > available:
+            msg = ("{} frames need {:.0f} MB of shared memory, but only "
+                   "{:.0f} MB are available in /dev/shm: lower --max-frames")
+            raise RuntimeError(msg.format(nslots, nslots * frame_bytes / 2**20,
+                                          available / 2**20))
+
+    reference_file = None
+    shm = None
+    frames = None
+    stages = []
+    stop = Event()
+    try:
+        if not args.no_align:
+            if args.alipy:
+                reference_file = NamedTemporaryFile(suffix=".fits")
+                pyfits.PrimaryHDU(data=reference[:, :, 1]).writeto(
+                    reference_file.name, clobber=True)
+            else:
+                reference_file = NamedTemporaryFile(suffix=".npy")
+                np.save(reference_file, 
+                        np.conj(box_spectrum(reference[:, :, 1], 
+                                             args.align_box)))
+                reference_file.flush()
+            args.reference_file = reference_file.name
+
+        shm = SharedMemory(create=True, size=nslots * frame_bytes)
+        frames = np.ndarray((nslots,) + shape, dtype=np.float32, 
+                            buffer=shm.buf)
+
+        # Workers are spawned, rather than forked, so that they do not 
+        # inherit the memory of this process and their peak RSS is their own.
+        context = get_context("spawn")
+        free_slots = context.Queue()
+        events = context.Queue()
+        queues = [context.Queue(maxsize=args.queue_size) 
+                  for _ in range(len(stage_jobs) + 1)]
+        for slot in range(1, nslots):
+            free_slots.put(slot)
+
+        # The reference frame goes straight to the stack.
+        frames[0] = reference
+        del reference
+        queues[-1].put((0, args.filenames[0]))
+
+        for n, (stage, jobs) in enumerate(stage_jobs):
+            procs = [context.Process(target=worker, 
+                                     args=(stage, queues[n], queues[n + 1], 
+                                           free_slots, events, shm.name,
+                                           nslots, shape, args))
+                     for _ in range(jobs)]
+            stages.append((stage, procs))
+            for proc in procs:
+                proc.start()
+        wait_ready(events, stages)
+
+        coordinator = Thread(target=coordinate, 
+                             args=(args.filenames[1:], stages, queues, stop))
+        coordinator.start()
+
+        # Stack, here, as the frames come out of the last stage.
+        out_frame = np.zeros(shape, dtype=np.float32)
+        stats = new_stats("stack")
+        while True:
+            start = time.perf_counter()
+            try:
+                item = queues[-1].get(timeout=1)
+            except Empty:
+                item = False
+            stats["wait_in"] += time.perf_counter() - start
+            dead = dead_workers(stages)
+            if dead:
+                raise RuntimeError("{} worker died".format(", ".join(dead)))
+            if item is False:
+                continue
+            if item is None:
+                break
+            start = time.perf_counter()
+            slot, fname = item
+            out_frame += frames[slot]
+            free_slots.put(slot)
+            stats["frames"] += 1
+            if args.checkpoint and stats["frames"] % args.checkpoint == 0:
+                checkpoint = out_frame / stats["frames"]
+                basename = args.output_file.split('.')[0]
+                for channel in range(shape[2]):
+                    pack_FITS(basename + "_checkpoint.fits", 
+                              checkpoint[:, :, channel], header, channel)
+            stats["busy"] += time.perf_counter() - start
+            if args.verbose:
+                stderr.write("{:.1%}\r".format(stats["frames"] / 
+                                               len(args.filenames)))
+        coordinator.join()
+
+        # All the workers exited cleanly, so they all sent their stats.
+        all_stats = []
+        while len(all_stats) < sum(jobs for _, jobs in stage_jobs):
+            try:
+                event = events.get(timeout=10)
+            except Empty:
+                raise RuntimeError("Missing statistics from the workers")
+            if event[0] == "stats":
+                all_stats.append(event[1])
+    finally:
+        stop.set()
+        for _, procs in stages:
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+                proc.join()
+        # the buffer cannot be closed while views on it exist.
+        frames = None
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+        if reference_file is not None:
+            reference_file.close()
+
+    # The reference is always stacked: the stack is only meaningful if some
+    # other frame made it, too.
+    if len(args.filenames) > 1 and stats["frames"] < 2:
+        raise RuntimeError("No frame other than the reference could be "
+                           "stacked")
+    dropped = len(args.filenames) - stats["frames"]
+    if dropped > 0:
+        msg = "Warning: {} of {} frames were dropped, see the failed column\n"
+        stderr.write(msg.format(dropped, len(args.filenames)))
+    out_frame /= stats["frames"]
+    header.set('NCOMBINE', stats["frames"])
+    for channel in range(shape[2]):
+        pack_FITS(args.output_file, out_frame[:, :, channel], header, channel)
+
+    stats["peak_rss"] = peak_rss()
+    all_stats.append(stats)
+    wall = time.perf_counter() - wall_start
+    summary = report(all_stats, wall)
+    if args.stats is not None:
+        with open(args.stats, 'w') as fout:
+            json.dump({"wall": wall, "stacked": stats["frames"], 
+                       "dropped": dropped, "stages": summary, 
+                       "workers": all_stats}, fout, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    args = par.parse_args()
+    args.no_demosaic = False
+    if args.use_libraw:
+        args.use_dcraw = False
+    if args.develop_jobs is None:
+        if args.lens_correction:
+            args.develop_jobs = max(1, cpu_count() // 2)
+        else:
+            args.develop_jobs = cpu_count()
+    if args.max_frames < 1 or args.queue_size < 1:
+        par.error("--max-frames and --queue-size must be at least 1")
+
+    try:
+        run(args)
+    except RuntimeError as err:
+        stderr.write("astro_pipeline: {}\n".format(err))
+        exit(1)
+    exit(0)